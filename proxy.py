@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 """Vertex AI Proxy – v29.1"""
 
-import os, json, subprocess, time, hashlib, sqlite3, threading
+import os, sys, json, asyncio, time, hashlib, sqlite3, threading, queue, logging, logging.handlers
 from typing import Dict, Any, Optional, Tuple, List
 from fastapi import FastAPI, Request, HTTPException, Response
 from fastapi.responses import StreamingResponse
-import httpx, uvicorn
+import httpx, uvicorn, orjson
+import google.auth, google.auth.credentials, google.auth.compute_engine
+from google.auth.transport.requests import Request as GARequest
 from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -19,9 +22,9 @@ VERTEX_AI_REGION   = os.getenv("VERTEX_AI_REGION", "us-west1")
 PROXY_HOST         = os.getenv("PROXY_HOST", "0.0.0.0")
 PROXY_PORT         = int(os.getenv("PROXY_PORT", "8000"))
 MAX_TOOL_CONTENT   = 30_000
+MAX_HISTORY_TURNS  = int(os.getenv("MAX_HISTORY_TURNS", "0"))
 CACHE_TTL_SECONDS  = 86400
 CACHE_MAX_ENTRIES  = 2000
-TOKEN_REFRESH_SECS = 1800
 CACHE_DB_PATH      = os.getenv("CACHE_DB_PATH", "/var/lib/vertexai-proxy/sig_cache.db")
 ANTHROPIC_API_KEY  = os.getenv("ANTHROPIC_API_KEY", "")
 ANTHROPIC_API_URL  = "https://api.anthropic.com/v1/messages"
@@ -37,48 +40,114 @@ AGENT_SYSTEM_INSTRUCTION = (
 )
 _CLAUDE4_ADAPTIVE = {"claude-opus-4-6", "claude-sonnet-4-6"}
 _CLAUDE4_BUDGET   = {"claude-opus-4-5", "claude-sonnet-4-5"}
+_TOOL_CALLS_MARK  = b'"tool_calls"'
+
+# ═══════════════════════════════════════════════════════════════
+#  JSON：orjson 快路径；孤立 UTF-16 代理项（如 "\ud83d"）orjson 不接受，回退 stdlib
+# ═══════════════════════════════════════════════════════════════
+def _loads(data: Any) -> Any:
+    try: return orjson.loads(data)
+    except orjson.JSONDecodeError: return json.loads(data)
+
+def _dumps(obj: Any) -> bytes:
+    try: return orjson.dumps(obj)
+    except TypeError: return json.dumps(obj).encode()
+
+# ═══════════════════════════════════════════════════════════════
+#  日志（QueueHandler → 后台线程写 stdout，不阻塞事件循环）
+# ═══════════════════════════════════════════════════════════════
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_out = logging.StreamHandler(sys.stdout)
+_log_out.setFormatter(logging.Formatter("%(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_out)
+log = logging.getLogger("vertexai-proxy")
+log.setLevel(logging.INFO); log.propagate = False
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
 
 # ═══════════════════════════════════════════════════════════════
 #  HTTP 客户端 + 生命周期
 # ═══════════════════════════════════════════════════════════════
 http_client: Optional[httpx.AsyncClient] = None
+vertex_clients: Dict[str, httpx.AsyncClient] = {}   # endpoint → 专用 HTTP/2 客户端
+
+def _new_client(**kw) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(300.0, connect=60.0),
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=120.0),
+        http2=True, verify=True, **kw,
+    )
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global http_client
+    global http_client, vertex_clients, _credentials, _token_lock
+    _log_listener.start()
+    _token_lock = asyncio.Lock()
     _get_db()
-    http_client = httpx.AsyncClient(
-        timeout=httpx.Timeout(300.0, connect=60.0),
-        limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=120.0),
-        http2=False, verify=True,
-    )
-    print("[SYSTEM] HTTP Client Initialized.")
+    if not _STATIC_TOKEN:
+        try: _credentials = await asyncio.to_thread(_load_credentials)
+        except Exception as e: log.error(f"[ERROR] Google credentials unavailable: {e}")
+    http_client = _new_client()
+    # Vertex 只有 global / regional 两个主机，各用一个客户端，在其 HTTP/2 连接上多路复用并发请求
+    vertex_clients = {ep: _new_client(base_url=ep) for ep in (_GLOBAL_EP, _REGIONAL_EP)}
+    log.info("[SYSTEM] HTTP Client Initialized.")
     yield
-    if http_client: await http_client.aclose()
-    if _db_conn:    _db_conn.close()
+    for c in (http_client, *vertex_clients.values()): await c.aclose()
+    if _db_conn: _db_conn.close()
+    _log_listener.stop()
 
 app = FastAPI(title="Vertex AI Proxy v29.1", lifespan=lifespan)
 
 # ═══════════════════════════════════════════════════════════════
-#  gcloud token 缓存
+#  Vertex token 缓存（google-auth，进程内刷新）
 # ═══════════════════════════════════════════════════════════════
-_token_cache: Dict[str, Any] = {"token": "", "ts": 0.0}
-
-def get_vertex_token() -> str:
-    if os.getenv("VERTEX_ACCESS_TOKEN"):
-        return os.getenv("VERTEX_ACCESS_TOKEN")
-    now = time.time()
-    if _token_cache["token"] and now - _token_cache["ts"] < TOKEN_REFRESH_SECS:
-        return _token_cache["token"]
-    try:
-        env = {**os.environ}; env.pop("GOOGLE_APPLICATION_CREDENTIALS", None)
-        r = subprocess.run(["gcloud","auth","application-default","print-access-token"],
-                           capture_output=True, text=True, check=True, env=env)
-        _token_cache.update(token=r.stdout.strip(), ts=now)
-        return _token_cache["token"]
-    except Exception as e:
-        print(f"[ERROR] Token refresh failed: {e}")
-        return _token_cache["token"]
+_token_lock: Optional[asyncio.Lock] = None   # 在 lifespan 中创建，绑定 uvicorn 实际运行的事件循环
+_STATIC_TOKEN = os.getenv("VERTEX_ACCESS_TOKEN", "")
+_credentials: Optional[google.auth.credentials.Credentials] = None
+_CLOUD_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+def _token_fresh() -> bool:
+    # valid 已扣除 google-auth 的提前刷新阈值；元数据服务器返回的 token 可能只剩几分钟，不能按固定时长缓存
+    return _credentials is not None and _credentials.valid
+
+def _token_expires_in() -> int:
+    """当前 token 剩余有效秒数；静态 token 或尚未获取时为 -1"""
+    if _STATIC_TOKEN or _credentials is None or _credentials.expiry is None: return -1
+    # google-auth 的 expiry 是不带时区的 UTC 时间
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return max(0, int((_credentials.expiry - now).total_seconds()))
+
+def _adc_path() -> str:
+    """gcloud auth application-default login 写入的 ADC 文件位置"""
+    cfg = os.getenv("CLOUDSDK_CONFIG") or (
+        os.path.join(os.getenv("APPDATA", ""), "gcloud") if os.name == "nt"
+        else os.path.join(os.path.expanduser("~"), ".config", "gcloud"))
+    return os.path.join(cfg, "application_default_credentials.json")
+
+def _load_credentials() -> google.auth.credentials.Credentials:
+    # 与 gcloud application-default 一致：不看 GOOGLE_APPLICATION_CREDENTIALS，直接读 ADC 文件；
+    # 文件不存在时（GCE / Cloud Run / GKE）使用元数据服务器
+    path = _adc_path()
+    if os.path.exists(path):
+        creds, _ = google.auth.load_credentials_from_file(path, scopes=_CLOUD_SCOPES)
+        return creds
+    return google.auth.compute_engine.Credentials(scopes=_CLOUD_SCOPES)
+
+def _refresh_token() -> str:
+    global _credentials
+    if _credentials is None: _credentials = _load_credentials()
+    _credentials.refresh(GARequest())
+    return _credentials.token
+
+async def get_vertex_token() -> str:
+    if _STATIC_TOKEN: return _STATIC_TOKEN
+    if _token_fresh(): return _credentials.token
+    async with _token_lock:
+        if _token_fresh(): return _credentials.token   # 并发请求只刷新一次
+        try:
+            return await asyncio.to_thread(_refresh_token)
+        except Exception as e:
+            log.error(f"[ERROR] Token refresh failed: {e}")
+            return ""
 
 # ═══════════════════════════════════════════════════════════════
 #  SQLite 签名缓存
@@ -99,14 +168,13 @@ def _get_db() -> sqlite3.Connection:
     c.execute("CREATE INDEX IF NOT EXISTS idx_ts ON sig_cache(ts)")
     c.commit()
     total = c.execute("SELECT COUNT(*) FROM sig_cache").fetchone()[0]
-    print(f"[SYSTEM] SQLite loaded: {total} sigs from {CACHE_DB_PATH}")
+    log.info(f"[SYSTEM] SQLite loaded: {total} sigs from {CACHE_DB_PATH}")
     _db_conn = c; return c
 
 def _user_ns(auth: str) -> str:
     return hashlib.sha256(auth.encode()).hexdigest()[:16]
 
 def sig_cache_put(ns: str, tc_id: str, sig: str) -> None:
-    global _write_count
     now = time.time()
     def _write():
         global _write_count
@@ -147,30 +215,55 @@ def _get_sig(tc: Dict) -> Optional[str]:
     return g.get("thought_signature") or tc.get("thought_signature")
 
 def _set_sig(tc: Dict, sig: str) -> Dict:
-    tc = {k: v for k, v in tc.items() if k != "thought_signature"}
-    eg = tc.get("extra_content") or {}
-    tc["extra_content"] = {**eg, "google": {**(eg.get("google") or {}), "thought_signature": sig}}
+    """原地写入签名：tc 来自本请求解析出的 JSON，无需复制"""
+    tc.pop("thought_signature", None)
+    eg = tc.get("extra_content") or {}; tc["extra_content"] = eg
+    g  = eg.get("google") or {};        eg["google"] = g
+    g["thought_signature"] = sig
     return tc
 
 # ═══════════════════════════════════════════════════════════════
 #  消息工具函数
 # ═══════════════════════════════════════════════════════════════
 def _flatten(content: Any) -> str:
-    if isinstance(content, str): return content
+    if type(content) is str: return content
     if isinstance(content, list):
-        return "\n".join(str(i.get("text","")) if isinstance(i,dict) else str(i) for i in content)
+        return "\n".join(i if type(i) is str else str(i.get("text","")) if type(i) is dict else str(i)
+                         for i in content)
     return str(content or "")
 
 def _normalize_user_content(content: Any) -> Any:
     """保留多模态 block 列表，纯文本时 flatten"""
+    if type(content) is str: return content
     if isinstance(content, list):
-        return [b if isinstance(b,dict) else {"type":"text","text":str(b)} for b in content]
+        return [b if type(b) is dict else {"type":"text","text":b if type(b) is str else str(b)} for b in content]
     return _flatten(content)
 
+_TOOL_HALF       = MAX_TOOL_CONTENT // 2
+_TOOL_SAFE_CHARS = MAX_TOOL_CONTENT // 4
+
 def _truncate(text: str) -> str:
-    if len(text) <= MAX_TOOL_CONTENT: return text
-    h = MAX_TOOL_CONTENT // 2
-    return text[:h] + f"\n\n[...Truncated {len(text)-MAX_TOOL_CONTENT} chars...]\n\n" + text[-h:]
+    """按 UTF-8 字节截断（中文/emoji 输出也不会超限），保留首尾各一半"""
+    if len(text) <= _TOOL_SAFE_CHARS: return text   # 每字符至多 4 字节，无需编码
+    b = text.encode("utf-8")
+    if len(b) <= MAX_TOOL_CONTENT: return text
+    return (f"{b[:_TOOL_HALF].decode('utf-8','ignore')}\n\n[...Truncated {len(b)-MAX_TOOL_CONTENT} bytes...]\n\n"
+            f"{b[-_TOOL_HALF:].decode('utf-8','ignore')}")
+
+def _bound_history(cleaned: List[Dict], req_id: str) -> List[Dict]:
+    """保留 system + 首条 user（原始任务）+ 最近 MAX_HISTORY_TURNS 条，中间折叠为一条提示；<=0 不截断"""
+    if MAX_HISTORY_TURNS <= 0: return cleaned
+    head = 1 if cleaned and cleaned[0].get("role") == "system" else 0
+    if head < len(cleaned) and cleaned[head].get("role") == "user": head += 1
+    start = len(cleaned) - MAX_HISTORY_TURNS
+    # 窗口不能以 tool 结果开头：回退到发起这些调用的 model 消息
+    while start > head and cleaned[start].get("role") == "tool": start -= 1
+    if start <= head: return cleaned
+    omitted = start - head
+    log.info(f"[{req_id}] [HISTORY] Truncated {omitted} earlier message(s)")
+    return (cleaned[:head]
+            + [{"role":"user","content":f"[History truncated: {omitted} earlier turns omitted]"}]
+            + cleaned[start:])
 
 def _chain_summary(messages: List[Dict]) -> List[str]:
     out = []
@@ -188,21 +281,20 @@ def _chain_summary(messages: List[Dict]) -> List[str]:
 # ═══════════════════════════════════════════════════════════════
 def _restore_tool_calls(tcs: List[Dict], req_id: str, ns: str) -> List[Dict]:
     # 第1步：按 id 从缓存恢复
-    restored = []
     for tc in tcs:
         if not _get_sig(tc):
             sig = sig_cache_get(ns, tc.get("id",""))
             if sig:
-                tc = _set_sig(tc, sig)
-                print(f"[{req_id}] [SIG] ✓ Restored id={tc.get('id')}")
+                _set_sig(tc, sig)
+                log.info(f"[{req_id}] [SIG] ✓ Restored id={tc.get('id')}")
             else:
-                print(f"[{req_id}] [SIG] ✗ Miss id={tc.get('id')}")
-        restored.append(tc)
+                log.info(f"[{req_id}] [SIG] ✗ Miss id={tc.get('id')}")
     # 第2步：批内广播
-    any_sig = next((_get_sig(tc) for tc in restored if _get_sig(tc)), None)
+    any_sig = next((sig for tc in tcs if (sig := _get_sig(tc))), None)
     if any_sig:
-        restored = [(_set_sig(tc,any_sig) if not _get_sig(tc) else tc) for tc in restored]
-    return restored
+        for tc in tcs:
+            if not _get_sig(tc): _set_sig(tc, any_sig)
+    return tcs
 
 def sanitize_and_restore(body: Dict[str,Any], req_id: str, ns: str) -> Dict[str,Any]:
     if "messages" not in body: return body
@@ -236,84 +328,91 @@ def sanitize_and_restore(body: Dict[str,Any], req_id: str, ns: str) -> Dict[str,
             cleaned.append({"role":"user","content":_normalize_user_content(raw)})
 
         else:
-            cleaned.append({**msg,"content":_flatten(raw)})
+            msg["content"] = _flatten(raw)
+            cleaned.append(msg)
 
     if not found_sys:
         cleaned.insert(0,{"role":"system","content":AGENT_SYSTEM_INSTRUCTION})
 
+    cleaned = _bound_history(cleaned, req_id)
     body["messages"] = cleaned
     _broadcast_signatures(cleaned, req_id, ns)
     return body
 
 def _broadcast_signatures(cleaned: List[Dict], req_id: str, ns: str) -> None:
     """全局广播：链内找 → 自己DB → 全局DB"""
+    # 无工具调用的对话（常见的单轮请求）无需查库
+    if not any(msg.get("tool_calls") for msg in cleaned if msg.get("role") == "model"): return
     sig = None
     for msg in cleaned:
-        sig = next((_get_sig(tc) for tc in (msg.get("tool_calls") or []) if _get_sig(tc)), None)
+        sig = next((s for tc in (msg.get("tool_calls") or []) if (s := _get_sig(tc))), None)
         if sig: break
     if not sig:
         sig = sig_cache_latest(ns)
-        if sig: print(f"[{req_id}] [SIG] ↗ Fallback: own DB ns={ns}")
+        if sig: log.info(f"[{req_id}] [SIG] ↗ Fallback: own DB ns={ns}")
     if not sig:
         sig = sig_cache_latest()
-        if sig: print(f"[{req_id}] [SIG] ↗ Fallback: global DB")
+        if sig: log.info(f"[{req_id}] [SIG] ↗ Fallback: global DB")
     if sig:
         filled = 0
         for msg in cleaned:
             if msg.get("role") != "model" or not msg.get("tool_calls"): continue
-            new_tcs = []
             for tc in msg["tool_calls"]:
-                if not _get_sig(tc): tc = _set_sig(tc, sig); filled += 1
-                new_tcs.append(tc)
-            msg["tool_calls"] = new_tcs
-        if filled: print(f"[{req_id}] [SIG] ↗ Global broadcast: filled {filled} orphan signature(s)")
+                if not _get_sig(tc): _set_sig(tc, sig); filled += 1
+        if filled: log.info(f"[{req_id}] [SIG] ↗ Global broadcast: filled {filled} orphan signature(s)")
 
 # ═══════════════════════════════════════════════════════════════
 #  Vertex 辅助
 # ═══════════════════════════════════════════════════════════════
+_MODEL_SUFFIXES = tuple((f"-{s}", s) for s in REASONING_LEVELS)
+_SUFFIX_ANY     = tuple(suffix for suffix, _ in _MODEL_SUFFIXES)
+
 def parse_model_id(model_id: str) -> Tuple[str, Optional[str]]:
-    for s in REASONING_LEVELS:
-        if model_id.endswith(f"-{s}"):
-            return model_id.rsplit(f"-{s}",1)[0], s
+    if not model_id.endswith(_SUFFIX_ANY): return model_id, None   # 常见情况：一次 C 级比较即返回
+    for suffix, s in _MODEL_SUFFIXES:
+        if model_id.endswith(suffix):
+            return model_id[:-len(suffix)], s
     return model_id, None
 
+_GLOBAL_EP   = f"https://aiplatform.googleapis.com/v1/projects/{VERTEX_AI_PROJECT}/locations/global/endpoints/openapi"
+_REGIONAL_EP = (f"https://{VERTEX_AI_REGION}-aiplatform.googleapis.com/v1/projects/{VERTEX_AI_PROJECT}"
+                f"/locations/{VERTEX_AI_REGION}/endpoints/openapi")
+
 def get_endpoint_url(base_model: str) -> str:
-    if "gemini-3" in base_model:
-        return f"https://aiplatform.googleapis.com/v1/projects/{VERTEX_AI_PROJECT}/locations/global/endpoints/openapi"
-    return f"https://{VERTEX_AI_REGION}-aiplatform.googleapis.com/v1/projects/{VERTEX_AI_PROJECT}/locations/{VERTEX_AI_REGION}/endpoints/openapi"
+    return _GLOBAL_EP if "gemini-3" in base_model else _REGIONAL_EP
 
 # ═══════════════════════════════════════════════════════════════
 #  流式透传 + 实时签名缓存（race condition 修复）
 # ═══════════════════════════════════════════════════════════════
 async def stream_and_cache(resp: httpx.Response, req_id: str, start: float, ns: str):
-    count = total = 0
+    total = 0
     first = False
     live_sigs: Dict[str,str]  = {}
     live_ids:  List[str]      = []
     live_map:  Dict[int,Dict] = {}   # index → {id, sig}
 
     try:
-        async for chunk in resp.aiter_bytes():
+        async for chunk in resp.aiter_raw():   # 上游已请求 identity 编码，原样透传
             if not first:
-                print(f"[{req_id}] [TTFT] {int((time.time()-start)*1000)}ms"); first = True
+                log.info(f"[{req_id}] [TTFT] {int((time.time()-start)*1000)}ms"); first = True
             yield chunk
-            total += len(chunk); count += 1
-            if count % 100 == 0:
-                print(f"[{req_id}] [STREAM] {count} chunks / {total/1024:.1f} KB")
-            # 实时解析签名，立即写 DB
+            total += len(chunk)
+            # 实时解析签名，立即写 DB（不含 tool_calls 的 chunk 直接跳过）
+            if _TOOL_CALLS_MARK not in chunk: continue
             for line in chunk.decode("utf-8","replace").splitlines():
                 if not line.startswith("data:"): continue
                 ds = line[5:].strip()
                 if not ds or ds == "[DONE]": continue
-                try: data = json.loads(ds)
+                try: data = orjson.loads(ds)
                 except: continue
                 for tcd in (((data.get("choices") or [{}])[0]).get("delta") or {}).get("tool_calls") or []:
                     idx = tcd.get("index",0)
                     if idx not in live_map: live_map[idx] = {"id":"","sig":""}
                     e = live_map[idx]
-                    if tcd.get("id") and not e["id"]:
-                        e["id"] = tcd["id"]
-                        if e["id"] not in live_ids: live_ids.append(e["id"])
+                    tc_id = tcd.get("id")
+                    if tc_id and not e["id"]:
+                        e["id"] = tc_id
+                        if tc_id not in live_ids: live_ids.append(tc_id)
                     g   = (tcd.get("extra_content") or {}).get("google") or {}
                     sig = (g.get("thought_signature")
                            or tcd.get("thought_signature")
@@ -325,10 +424,10 @@ async def stream_and_cache(resp: httpx.Response, req_id: str, start: float, ns:
                             sig_cache_put(ns, e["id"], e["sig"])  # 立即写
 
     except Exception as ex:
-        print(f"[{req_id}] [ERROR] Stream: {ex}"); raise
+        log.error(f"[{req_id}] [ERROR] Stream: {ex}"); raise
     finally:
         await resp.aclose()
-        print(f"[{req_id}] [DONE] {total/1024:.1f} KB in {time.time()-start:.2f}s")
+        log.info(f"[{req_id}] [DONE] {total/1024:.1f} KB in {time.time()-start:.2f}s")
         # finally：用完整签名覆盖写（修复分片残缺）
         for e in live_map.values():
             if e["id"] and e["sig"]:
@@ -340,8 +439,8 @@ async def stream_and_cache(resp: httpx.Response, req_id: str, start: float, ns:
             for tc_id in live_ids:
                 if tc_id not in live_sigs:
                     sig_cache_put(ns, tc_id, any_sig)
-                    print(f"[{req_id}] [SIG] ↗ Broadcast to id={tc_id}")
-        if live_sigs: print(f"[{req_id}] [SIG] Cached {len(live_sigs)} signature(s)")
+                    log.info(f"[{req_id}] [SIG] ↗ Broadcast to id={tc_id}")
+        if live_sigs: log.info(f"[{req_id}] [SIG] Cached {len(live_sigs)} signature(s)")
 
 # ═══════════════════════════════════════════════════════════════
 #  主路由
@@ -349,50 +448,59 @@ async def stream_and_cache(resp: httpx.Response, req_id: str, start: float, ns:
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
     req_id = str(int(time.time()*1000))[-6:]
-    print(f"[{req_id}] ← Request")
+    log.info(f"[{req_id}] ← Request")
     auth = request.headers.get("Authorization","")
     ns   = _user_ns(auth) if auth else "anonymous"
     try:
-        raw  = await request.json()
+        raw  = _loads(await request.body())
         mid  = raw.get("model","")
         if mid.startswith("anthropic/") or mid.startswith("claude-"):
             return await _forward_anthropic(raw, req_id)
 
-        body = sanitize_and_restore(raw, req_id, ns)
+        # 只有带 tool_calls 的助手消息才需要查询 SQLite（可能等待写线程持有的锁），
+        # 此时放到线程池避免阻塞事件循环；其余请求直接内联处理，省去线程切换
+        if any(m.get("tool_calls") for m in raw.get("messages", []) if m.get("role") == "assistant"):
+            body = await asyncio.to_thread(sanitize_and_restore, raw, req_id, ns)
+        else:
+            body = sanitize_and_restore(raw, req_id, ns)
         if "tools" in body and "tool_choice" not in body:
             body["tool_choice"] = "auto"
         base, _ = parse_model_id(body.get("model",""))
-        vbody   = {**body, "model": base}
-        vbody.pop("reasoning_effort", None)
+        body["model"] = base
+        body.pop("reasoning_effort", None)
 
-        print(f"[{req_id}] Chain({len(vbody.get('messages',[]))}) ns={ns}: {_chain_summary(vbody.get('messages',[]))}")
+        log.info(f"[{req_id}] Chain({len(body.get('messages',[]))}) ns={ns}: {_chain_summary(body.get('messages',[]))}")
 
-        token = get_vertex_token()
+        token = await get_vertex_token()
         if not token: raise HTTPException(500, "Failed to obtain Vertex AI access token.")
 
-        stream  = bool(vbody.get("stream", False))
-        req_obj = http_client.build_request(
-            "POST", get_endpoint_url(base) + "/chat/completions", json=vbody,
-            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
-        print(f"[{req_id}] → Vertex ({base})")
+        stream  = bool(body.get("stream", False))
+        client  = vertex_clients[get_endpoint_url(base)]
+        req_obj = client.build_request(
+            "POST", "/chat/completions", content=_dumps(body),
+            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json",
+                     "Accept-Encoding": "identity"})
+        log.info(f"[{req_id}] → Vertex ({base})")
         start = time.time()
-        resp  = await http_client.send(req_obj, stream=stream)
+        resp  = await client.send(req_obj, stream=stream)
 
         if resp.status_code >= 400:
             err = await resp.aread()
-            print(f"[{req_id}] [ERROR] Vertex {resp.status_code}: {err[:500]}")
-            return Response(content=err, status_code=resp.status_code, media_type="application/json")
+            log.error(f"[{req_id}] [ERROR] Vertex {resp.status_code}: {err[:500].decode('utf-8','replace')}")
+            return Response(content=err, status_code=resp.status_code,
+                            media_type=resp.headers.get("content-type","application/json"))
 
         if not stream:
             data = await resp.aread(); await resp.aclose()
-            print(f"[{req_id}] [DONE] Vertex non-stream in {time.time()-start:.2f}s")
-            return Response(content=data, status_code=resp.status_code, media_type="application/json")
+            log.info(f"[{req_id}] [DONE] Vertex non-stream in {time.time()-start:.2f}s")
+            return Response(content=data, status_code=resp.status_code,
+                            media_type=resp.headers.get("content-type","application/json"))
 
-        return StreamingResponse(stream_and_cache(resp, req_id, start, ns),
-                                 status_code=resp.status_code, media_type="text/event-stream")
+        return StreamingResponse(stream_and_cache(resp, req_id, start, ns), status_code=resp.status_code,
+                                 media_type=resp.headers.get("content-type","text/event-stream"))
     except HTTPException: raise
     except Exception as e:
-        import traceback; traceback.print_exc(); raise HTTPException(500, str(e))
+        log.exception(f"[{req_id}] [ERROR] Unhandled: {e}"); raise HTTPException(500, str(e))
 
 # ═══════════════════════════════════════════════════════════════
 #  Anthropic：消息转换
@@ -433,7 +541,7 @@ def _convert_messages(messages: List[Dict]) -> Tuple[List[str], List[Dict]]:
             for tc in (tcs or []):
                 fn = tc.get("function",{})
                 args = fn.get("arguments","{}")
-                try: args = json.loads(args) if isinstance(args,str) else args
+                try: args = _loads(args) if isinstance(args,str) else args
                 except: args = {}
                 blocks.append({"type":"tool_use","id":tc.get("id",""),"name":fn.get("name",""),"input":args})
             if not blocks: blocks.append({"type":"text","text":""})
@@ -536,34 +644,35 @@ async def _stream_anthropic(resp: httpx.Response, req_id: str, start: float, mod
     try:
         async for chunk in resp.aiter_bytes():
             buffer += chunk.decode("utf-8","replace")
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n",1)
+            *lines, buffer = buffer.split("\n")   # 一次切分，避免逐行重建 buffer
+            out: List[bytes] = []   # 同一上游 chunk 产生的事件合并成一次 yield
+            for line in lines:
                 line = line.strip()
                 if not line.startswith("data:"): continue
                 raw = line[5:].strip()
                 if not raw: continue
                 try:
-                    ev = json.loads(raw); et = ev.get("type","")
+                    ev = _loads(raw); et = ev.get("type","")
 
                     if et == "message_start":
                         msg_id  = ev.get("message",{}).get("id","")
                         created = int(time.time())
-                        yield _sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
-                                    "model":model_id,"choices":[{"delta":{"role":"assistant"},"index":0}]})
+                        out.append(_sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
+                                         "model":model_id,"choices":[{"delta":{"role":"assistant"},"index":0}]}))
                         role_sent = True
 
                     elif et == "content_block_start":
                         b = ev.get("content_block",{})
                         if b.get("type") == "tool_use":
                             if not role_sent:
-                                yield _sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
-                                            "model":model_id,"choices":[{"delta":{"role":"assistant"},"index":0}]})
+                                out.append(_sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
+                                                 "model":model_id,"choices":[{"delta":{"role":"assistant"},"index":0}]}))
                                 role_sent = True
-                            yield _sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
-                                        "model":model_id,"choices":[{"delta":{"tool_calls":[{
-                                            "index":ev.get("index",0),"id":b.get("id",""),"type":"function",
-                                            "function":{"name":b.get("name",""),"arguments":""}}]},
-                                            "index":0}]})
+                            out.append(_sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
+                                             "model":model_id,"choices":[{"delta":{"tool_calls":[{
+                                                 "index":ev.get("index",0),"id":b.get("id",""),"type":"function",
+                                                 "function":{"name":b.get("name",""),"arguments":""}}]},
+                                                 "index":0}]}))
 
                     elif et == "content_block_delta":
                         d = ev.get("delta",{})
@@ -571,39 +680,40 @@ async def _stream_anthropic(resp: httpx.Response, req_id: str, start: float, mod
                             pass  # 过滤思考内容
                         elif d.get("type") == "text_delta":
                             if not role_sent:
-                                yield _sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
-                                            "model":model_id,"choices":[{"delta":{"role":"assistant"},"index":0}]})
+                                out.append(_sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
+                                                 "model":model_id,"choices":[{"delta":{"role":"assistant"},"index":0}]}))
                                 role_sent = True
-                            yield _sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
-                                        "model":model_id,"choices":[{"delta":{"content":d.get("text","")},"index":0}]})
+                            out.append(_sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
+                                             "model":model_id,"choices":[{"delta":{"content":d.get("text","")},"index":0}]}))
                         elif d.get("type") == "input_json_delta":
-                            yield _sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
-                                        "model":model_id,"choices":[{"delta":{"tool_calls":[{
-                                            "index":ev.get("index",0),
-                                            "function":{"arguments":d.get("partial_json","")}}]},
-                                            "index":0}]})
+                            out.append(_sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
+                                             "model":model_id,"choices":[{"delta":{"tool_calls":[{
+                                                 "index":ev.get("index",0),
+                                                 "function":{"arguments":d.get("partial_json","")}}]},
+                                                 "index":0}]}))
 
                     elif et == "message_delta":
                         finish = _map_stop_reason(ev.get("delta",{}).get("stop_reason"))
-                        yield _sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
-                                    "model":model_id,"choices":[{"delta":{},"index":0,"finish_reason":finish}]})
+                        out.append(_sse({"id":msg_id,"object":"chat.completion.chunk","created":created,
+                                         "model":model_id,"choices":[{"delta":{},"index":0,"finish_reason":finish}]}))
 
                     elif et == "message_stop":
-                        yield b"data: [DONE]\n\n"
+                        out.append(b"data: [DONE]\n\n")
 
                 except Exception: pass
+            if out: yield b"".join(out)
     finally:
         # 处理末尾残留
         if buffer.strip().startswith("data:"):
             try:
-                ev = json.loads(buffer.strip()[5:].strip())
+                ev = _loads(buffer.strip()[5:].strip())
                 if ev.get("type") == "message_stop": yield b"data: [DONE]\n\n"
             except: pass
         await resp.aclose()
-        print(f"[{req_id}] [DONE] Anthropic stream in {time.time()-start:.2f}s")
+        log.info(f"[{req_id}] [DONE] Anthropic stream in {time.time()-start:.2f}s")
 
 def _sse(obj: dict) -> bytes:
-    return f"data: {json.dumps(obj, ensure_ascii=False)}\n\n".encode()
+    return b"data: " + _dumps(obj) + b"\n\n"
 
 # ═══════════════════════════════════════════════════════════════
 #  Anthropic：主入口
@@ -622,27 +732,28 @@ async def _forward_anthropic(body: dict, req_id: str):
     ab, thinking = _build_anthropic_body(body, model_id, msgs, system_blocks, tools)
     headers      = _build_anthropic_headers(model_id, thinking, body)
 
-    print(f"[{req_id}] → Anthropic ({model_id}) msgs={len(msgs)} stream={stream} thinking={thinking}")
+    log.info(f"[{req_id}] → Anthropic ({model_id}) msgs={len(msgs)} stream={stream} thinking={thinking}")
     start = time.time()
 
-    req_obj = http_client.build_request("POST", ANTHROPIC_API_URL, json=ab, headers=headers)
+    req_obj = http_client.build_request("POST", ANTHROPIC_API_URL, content=_dumps(ab), headers=headers)
     resp    = await http_client.send(req_obj, stream=True)
 
     if resp.status_code >= 400:
         err = await resp.aread()
-        print(f"[{req_id}] [ERROR] Anthropic {resp.status_code}: {err[:500]}")
-        return Response(content=err, status_code=resp.status_code, media_type="application/json")
+        log.error(f"[{req_id}] [ERROR] Anthropic {resp.status_code}: {err[:500].decode('utf-8','replace')}")
+        return Response(content=err, status_code=resp.status_code,
+                        media_type=resp.headers.get("content-type","application/json"))
 
     if not stream:
         data = await resp.aread(); await resp.aclose()  # Bug1: 释放连接
         try:
-            ar = json.loads(data)
+            ar = _loads(data)
             blocks = ar.get("content",[])
             text   = "\n".join(b.get("text","") for b in blocks if b.get("type")=="text" and b.get("text"))
             tcs    = [{"id":b["id"],"type":"function","function":{
-                           "name":b["name"],"arguments":json.dumps(b.get("input",{}),ensure_ascii=False)}}
+                           "name":b["name"],"arguments":_dumps(b.get("input",{})).decode()}}
                       for b in blocks if b.get("type")=="tool_use"]
-            return Response(content=json.dumps({
+            return Response(content=_dumps({
                 "id":ar.get("id",""),"object":"chat.completion","created":int(time.time()),
                 "model":model_id,
                 "choices":[{"index":0,"message":{"role":"assistant",
@@ -652,9 +763,9 @@ async def _forward_anthropic(body: dict, req_id: str):
                          "completion_tokens":ar.get("usage",{}).get("output_tokens",0),
                          "total_tokens":ar.get("usage",{}).get("input_tokens",0)
                                         +ar.get("usage",{}).get("output_tokens",0)}
-            }, ensure_ascii=False), media_type="application/json")
+            }), media_type="application/json")
         except Exception as e:
-            print(f"[{req_id}] [ERROR] Anthropic parse: {e}")
+            log.error(f"[{req_id}] [ERROR] Anthropic parse: {e}")
             return Response(content=data, status_code=200, media_type="application/json")
 
     return StreamingResponse(_stream_anthropic(resp, req_id, start, model_id),
@@ -663,19 +774,21 @@ async def _forward_anthropic(body: dict, req_id: str):
 # ═══════════════════════════════════════════════════════════════
 #  健康检查
 # ═══════════════════════════════════════════════════════════════
+def _db_stats() -> Tuple[int, int]:
+    with _db_lock:
+        db = _get_db()
+        return (db.execute("SELECT COUNT(*) FROM sig_cache").fetchone()[0],
+                db.execute("SELECT COUNT(DISTINCT ns) FROM sig_cache").fetchone()[0])
+
 @app.get("/health")
 async def health():
-    token_age = int(time.time()-_token_cache["ts"]) if _token_cache["ts"] else -1
-    try:
-        with _db_lock:
-            db = _get_db()
-            total_sigs = db.execute("SELECT COUNT(*) FROM sig_cache").fetchone()[0]
-            active_ns  = db.execute("SELECT COUNT(DISTINCT ns) FROM sig_cache").fetchone()[0]
+    try:    total_sigs, active_ns = await asyncio.to_thread(_db_stats)
     except: total_sigs = active_ns = -1
     return {"status":"ok","version":"v29.1","active_namespaces":active_ns,
             "cached_signatures":total_sigs,"cache_db":CACHE_DB_PATH,
-            "token_age_seconds":token_age,
-            "token_valid": token_age < TOKEN_REFRESH_SECS if token_age >= 0 else False}
+            "token_expires_in_seconds":_token_expires_in(),
+            "token_valid": bool(_STATIC_TOKEN) or _token_fresh()}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host=PROXY_HOST, port=PROXY_PORT, log_level="info")
+    uvicorn.run(app, host=PROXY_HOST, port=PROXY_PORT, loop="uvloop", http="httptools",
+                log_level="info", access_log=False)
@@ -1,6 +1,9 @@
+import asyncio
 import json
 import tempfile
+import time
 import unittest
+from datetime import datetime, timedelta, timezone
 
 from fastapi.testclient import TestClient
 
@@ -8,8 +11,9 @@ import proxy
 
 
 class FakeResponse:
-    def __init__(self, status_code=200, body=b"", chunks=None):
+    def __init__(self, status_code=200, body=b"", chunks=None, headers=None):
         self.status_code = status_code
+        self.headers = headers or {}
         self._body = body
         self._chunks = list(chunks or [])
         self.closed = False
@@ -21,6 +25,10 @@ class FakeResponse:
         for chunk in self._chunks:
             yield chunk
 
+    async def aiter_raw(self):
+        for chunk in self._chunks:
+            yield chunk
+
     async def aclose(self):
         self.closed = True
 
@@ -33,7 +41,9 @@ class FakeHttpClient:
     def queue_response(self, response):
         self.responses.append(response)
 
-    def build_request(self, method, url, json=None, headers=None):
+    def build_request(self, method, url, json=None, content=None, headers=None):
+        if content is not None:
+            json = proxy.json.loads(content)
         req = {"method": method, "url": url, "json": json, "headers": headers or {}}
         self.requests.append(req)
         return req
@@ -48,26 +58,61 @@ class FakeHttpClient:
         return None
 
 
+class FakeCredentials:
+    def __init__(self, token="", valid=False, expiry=None):
+        self.token = token
+        self.valid = valid
+        self.expiry = expiry
+
+
 class ProxyFormatTests(unittest.TestCase):
     def setUp(self):
         self.tempdir = tempfile.TemporaryDirectory()
         proxy.CACHE_DB_PATH = f"{self.tempdir.name}/sig_cache.db"
         proxy._db_conn = None
-        proxy._token_cache["token"] = ""
-        proxy._token_cache["ts"] = 0.0
-        proxy.VERTEX_AI_PROJECT = "test-project"
-        proxy.VERTEX_AI_REGION = "us-west1"
+        proxy._STATIC_TOKEN = "test-token"
+        proxy._credentials = None
         proxy.ANTHROPIC_API_KEY = "test-key"
         self.fake_http = FakeHttpClient()
         proxy.http_client = self.fake_http
         self.client = TestClient(proxy.app)
         self.client.__enter__()
         proxy.http_client = self.fake_http
+        self.real_vertex_clients = proxy.vertex_clients
+        self.fake_global = FakeHttpClient()
+        self.fake_regional = FakeHttpClient()
+        proxy.vertex_clients = {proxy._GLOBAL_EP: self.fake_global, proxy._REGIONAL_EP: self.fake_regional}
 
     def tearDown(self):
         self.client.__exit__(None, None, None)
         self.tempdir.cleanup()
 
+    def test_vertex_endpoint_clients_join_chat_completions_onto_base_url(self):
+        project, region = proxy.VERTEX_AI_PROJECT, proxy.VERTEX_AI_REGION
+        expected = {
+            proxy._GLOBAL_EP: f"https://aiplatform.googleapis.com/v1/projects/{project}"
+                              f"/locations/global/endpoints/openapi/chat/completions",
+            proxy._REGIONAL_EP: f"https://{region}-aiplatform.googleapis.com/v1/projects/{project}"
+                                f"/locations/{region}/endpoints/openapi/chat/completions",
+        }
+        for ep, url in expected.items():
+            req = self.real_vertex_clients[ep].build_request("POST", "/chat/completions")
+            self.assertEqual(str(req.url), url)
+
+    def test_vertex_routes_gemini_3_to_global_and_others_to_regional(self):
+        for model in ("google/gemini-3.1-flash-lite-preview", "google/gemini-2.5-pro"):
+            fake = self.fake_global if "gemini-3" in model else self.fake_regional
+            fake.queue_response(FakeResponse(body=b"{}"))
+            response = self.client.post(
+                "/v1/chat/completions",
+                json={"model": model, "messages": [{"role": "user", "content": "hi"}]},
+            )
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual([r["json"]["model"] for r in self.fake_global.requests], ["google/gemini-3.1-flash-lite-preview"])
+        self.assertEqual([r["json"]["model"] for r in self.fake_regional.requests], ["google/gemini-2.5-pro"])
+        self.assertEqual(self.fake_http.requests, [])
+
     def test_vertex_non_stream_returns_json_and_preserves_user_blocks(self):
         upstream = {
             "id": "chatcmpl-vertex",
@@ -77,7 +122,7 @@ class ProxyFormatTests(unittest.TestCase):
             "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
             "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
         }
-        self.fake_http.queue_response(FakeResponse(body=json.dumps(upstream).encode()))
+        self.fake_global.queue_response(FakeResponse(body=json.dumps(upstream).encode()))
 
         response = self.client.post(
             "/v1/chat/completions",
@@ -96,11 +141,189 @@ class ProxyFormatTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue(response.headers["content-type"].startswith("application/json"))
         self.assertEqual(response.json()["id"], "chatcmpl-vertex")
-        sent_body = self.fake_http.requests[0]["json"]
-        self.assertFalse(self.fake_http.requests[0]["stream"])
+        sent_body = self.fake_global.requests[0]["json"]
+        self.assertFalse(self.fake_global.requests[0]["stream"])
         self.assertIsInstance(sent_body["messages"][1]["content"], list)
         self.assertEqual(sent_body["messages"][1]["content"][1]["type"], "image_url")
 
+    def _post_history(self, messages):
+        self.fake_regional.queue_response(FakeResponse(body=b"{}"))
+        response = self.client.post(
+            "/v1/chat/completions",
+            json={"model": "google/gemini-2.5-pro", "messages": messages},
+        )
+        self.assertEqual(response.status_code, 200)
+        return self.fake_regional.requests[-1]["json"]["messages"]
+
+    def test_vertex_history_is_not_bounded_by_default(self):
+        messages = [{"role": "user", "content": str(i)} for i in range(200)]
+        self.assertEqual(len(self._post_history(messages)), 201)
+
+    def test_vertex_history_keeps_task_and_does_not_orphan_tool_results(self):
+        proxy.MAX_HISTORY_TURNS = 2
+        self.addCleanup(setattr, proxy, "MAX_HISTORY_TURNS", 0)
+
+        sent = self._post_history([
+            {"role": "system", "content": "sys"},
+            {"role": "user", "content": "task"},
+            {"role": "assistant", "content": "a1"},
+            {"role": "user", "content": "u2"},
+            {"role": "assistant", "content": "", "tool_calls": [
+                {"id": "call_1", "type": "function", "function": {"name": "f", "arguments": "{}"}},
+                {"id": "call_2", "type": "function", "function": {"name": "g", "arguments": "{}"}}]},
+            {"role": "tool", "tool_call_id": "call_1", "content": "r1"},
+            {"role": "tool", "tool_call_id": "call_2", "content": "r2"},
+        ])
+
+        self.assertEqual([m["role"] for m in sent], ["system", "user", "user", "model", "tool", "tool"])
+        self.assertEqual(sent[1]["content"], "task")
+        self.assertIn("2 earlier turns omitted", sent[2]["content"])
+        self.assertEqual([tc["id"] for tc in sent[3]["tool_calls"]], ["call_1", "call_2"])
+
+    def test_vertex_restores_cached_signature_and_broadcasts_within_batch(self):
+        proxy.sig_cache_put("anonymous", "call_1", "sig-cached")
+        for _ in range(50):
+            if proxy.sig_cache_get("anonymous", "call_1"):
+                break
+            time.sleep(0.01)
+        self.fake_regional.queue_response(FakeResponse(body=b"{}"))
+
+        response = self.client.post(
+            "/v1/chat/completions",
+            json={
+                "model": "google/gemini-2.5-pro",
+                "messages": [
+                    {"role": "user", "content": "go"},
+                    {"role": "assistant", "content": None, "tool_calls": [
+                        {"id": "call_1", "type": "function", "function": {"name": "f", "arguments": "{}"}},
+                        {"id": "call_2", "type": "function", "function": {"name": "g", "arguments": "{}"},
+                         "thought_signature": None},
+                    ]},
+                    {"role": "tool", "tool_call_id": "call_1", "content": "a"},
+                    {"role": "tool", "tool_call_id": "call_2", "content": "b"},
+                ],
+            },
+        )
+
+        self.assertEqual(response.status_code, 200)
+        tcs = self.fake_regional.requests[0]["json"]["messages"][2]["tool_calls"]
+        for tc in tcs:
+            self.assertEqual(tc["extra_content"]["google"]["thought_signature"], "sig-cached")
+            self.assertNotIn("thought_signature", tc)
+
+    def _stub_refresh(self, token):
+        calls = []
+
+        def refresh():
+            calls.append(1)
+            time.sleep(0.05)
+            proxy._credentials = FakeCredentials(token, valid=True)
+            return token
+
+        proxy._STATIC_TOKEN = ""
+        self.addCleanup(setattr, proxy, "_refresh_token", proxy._refresh_token)
+        proxy._refresh_token = refresh
+        return calls
+
+    def test_concurrent_cold_token_requests_refresh_once(self):
+        calls = self._stub_refresh("fresh")
+
+        async def run():
+            proxy._token_lock = asyncio.Lock()
+            return await asyncio.gather(*(proxy.get_vertex_token() for _ in range(5)))
+
+        self.assertEqual(asyncio.run(run()), ["fresh"] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_expired_credentials_are_refreshed(self):
+        calls = self._stub_refresh("new")
+        proxy._credentials = FakeCredentials("old", valid=False)
+
+        async def run():
+            proxy._token_lock = asyncio.Lock()
+            return [await proxy.get_vertex_token(), await proxy.get_vertex_token()]
+
+        self.assertEqual(asyncio.run(run()), ["new", "new"])
+        self.assertEqual(len(calls), 1)
+
+    def test_health_reports_remaining_token_lifetime(self):
+        self.assertEqual(self.client.get("/health").json()["token_expires_in_seconds"], -1)
+
+        proxy._STATIC_TOKEN = ""
+        expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=600)
+        proxy._credentials = FakeCredentials("tok", valid=True, expiry=expiry)
+        health = self.client.get("/health").json()
+
+        self.assertTrue(health["token_valid"])
+        self.assertTrue(590 <= health["token_expires_in_seconds"] <= 600)
+
+    def test_truncate_bounds_tool_output_by_utf8_bytes(self):
+        text = "测" * proxy.MAX_TOOL_CONTENT
+        out = proxy._truncate(text)
+
+        head, marker, tail = out.partition("\n\n[...Truncated ")
+        self.assertTrue(marker)
+        self.assertLessEqual(len(head.encode()) + len(tail.split("...]\n\n", 1)[1].encode()),
+                             proxy.MAX_TOOL_CONTENT)
+        self.assertIn(f"{len(text.encode()) - proxy.MAX_TOOL_CONTENT} bytes", out)
+        self.assertEqual(proxy._truncate("short"), "short")
+
+    def test_vertex_forwards_lone_surrogate_tool_output(self):
+        self.fake_regional.queue_response(FakeResponse(body=b"{}"))
+
+        response = self.client.post(
+            "/v1/chat/completions",
+            content=b'{"model":"google/gemini-2.5-pro","messages":['
+                    b'{"role":"user","content":"run"},'
+                    b'{"role":"tool","tool_call_id":"call_1","content":"out \\ud83d"}]}',
+            headers={"Content-Type": "application/json"},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.fake_regional.requests[0]["json"]["messages"][2]["content"], "out \ud83d")
+
+    def test_vertex_error_forwards_upstream_content_type(self):
+        self.fake_regional.queue_response(FakeResponse(
+            status_code=429, body=b"quota exceeded", headers={"content-type": "text/plain"}))
+
+        response = self.client.post(
+            "/v1/chat/completions",
+            json={"model": "google/gemini-2.5-pro", "messages": [{"role": "user", "content": "hi"}]},
+        )
+
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+        self.assertEqual(response.content, b"quota exceeded")
+
+    def test_vertex_stream_passes_chunks_through_and_caches_signature(self):
+        chunks = [
+            b'data: {"choices":[{"index":0,"delta":{"role":"assistant","content":"hi"}}]}\n\n',
+            b'data: {"choices":[{"index":0,"delta":{"tool_calls":[{"index":0,"id":"call_1",'
+            b'"extra_content":{"google":{"thought_signature":"sig-abc"}}}]}}]}\n\n',
+            b"data: [DONE]\n\n",
+        ]
+        self.fake_global.queue_response(FakeResponse(chunks=chunks))
+
+        with self.client.stream(
+            "POST",
+            "/v1/chat/completions",
+            json={
+                "model": "google/gemini-3.1-flash-lite-preview",
+                "stream": True,
+                "messages": [{"role": "user", "content": "hi"}],
+            },
+        ) as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+            body = b"".join(response.iter_bytes())
+
+        self.assertEqual(body, b"".join(chunks))
+        for _ in range(50):
+            if proxy.sig_cache_get("anonymous", "call_1"):
+                break
+            time.sleep(0.01)
+        self.assertEqual(proxy.sig_cache_get("anonymous", "call_1"), "sig-abc")
+
     def test_anthropic_non_stream_maps_required_tool_choice_and_length_finish_reason(self):
         upstream = {
             "id": "msg_123",
@@ -135,6 +358,24 @@ class ProxyFormatTests(unittest.TestCase):
         sent_body = self.fake_http.requests[0]["json"]
         self.assertEqual(sent_body["tool_choice"], {"type": "any"})
 
+    def test_anthropic_forwards_lone_surrogate_tool_output(self):
+        upstream = {"id": "msg_1", "content": [{"type": "text", "text": "ok"}], "stop_reason": "end_turn"}
+        self.fake_http.queue_response(FakeResponse(body=json.dumps(upstream).encode()))
+
+        response = self.client.post(
+            "/v1/chat/completions",
+            content=b'{"model":"anthropic/claude-sonnet-4-5","messages":['
+                    b'{"role":"user","content":"run"},'
+                    b'{"role":"assistant","content":null,"tool_calls":[{"id":"call_1","type":"function",'
+                    b'"function":{"name":"f","arguments":"{}"}}]},'
+                    b'{"role":"tool","tool_call_id":"call_1","content":"out \\ud83d"}]}',
+            headers={"Content-Type": "application/json"},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        sent = self.fake_http.requests[0]["json"]["messages"]
+        self.assertEqual(sent[-1]["content"][0]["content"], "out \ud83d")
+
     def test_anthropic_stream_emits_openai_style_chunks(self):
         chunks = [
             b'data: {"type":"message_start","message":{"id":"msg_abc"}}\n\n',
@@ -158,11 +399,14 @@ class ProxyFormatTests(unittest.TestCase):
             self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
             text = "".join(response.iter_text())
 
-        self.assertIn('"object": "chat.completion.chunk"', text)
-        self.assertIn('"role": "assistant"', text)
-        self.assertIn('"model": "claude-sonnet-4-5"', text)
-        self.assertIn('"finish_reason": "length"', text)
-        self.assertIn("data: [DONE]", text)
+        frames = [line[len("data: "):] for line in text.split("\n\n") if line.startswith("data: ")]
+        self.assertEqual(frames[-1], "[DONE]")
+        events = [json.loads(frame) for frame in frames[:-1]]
+        self.assertTrue(all(e["object"] == "chat.completion.chunk" for e in events))
+        self.assertTrue(all(e["model"] == "claude-sonnet-4-5" for e in events))
+        self.assertEqual(events[0]["choices"][0]["delta"], {"role": "assistant"})
+        self.assertEqual("".join(e["choices"][0]["delta"].get("content", "") for e in events), "Hello")
+        self.assertEqual(events[-1]["choices"][0]["finish_reason"], "length")
 
 
 if __name__ == "__main__":